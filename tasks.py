@@ -14,18 +14,37 @@ except ImportError:
 from robocorp import browser
 from robocorp import workitems
 from robocorp.tasks import task
-from RPA.Excel.Files import Files as Excel
+from playwright.sync_api import Route
+from openpyxl import Workbook
 
 from typing import Literal
 from datetime import datetime, timedelta, date
-from hashlib import shake_128
+from functools import lru_cache
 import re
-from bs4 import BeautifulSoup
+import ahocorasick
 
 from concurrent.futures import ThreadPoolExecutor
-from urllib.request import urlretrieve
+import shutil
+import urllib3
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
+# Number of threads downloading images, the downloads are network bound
+IMG_DL_WORKERS = int(os.getenv("IMG_DL_WORKERS", "32"))
+# Shared connection pool for the image downloads, sized to the number of download threads
+http_pool = urllib3.PoolManager(
+    num_pools=4, maxsize=IMG_DL_WORKERS, block=True)
+
+# The pattern of a price starting with a dollar sign. Enforce that the number starts with a non-zero digit and that commas are used as separators for thousands, the number may only be followed by trailing commas or periods.
+DOLLAR_RE = re.compile(r'\$[1-9]\d{0,2}(?:,\d{3})*(?:\.\d+)?(?![\d,.]*\d)')
+# The pattern of a price ending the string with "dollars" or "USD". The number follows the same rules, leading commas or periods are skipped unless they follow a word character or a dollar sign.
+SUFFIX_RE = re.compile(
+    r'(?<![\w,.$])[,.]*[1-9]\d{0,2}(?:,\d{3})*(?:\.\d+)? (?:dollars|USD)\b$')
+# The characters to be removed from the query words in the output filename
+KEEP_CHARS = re.compile('[^a-zA-Z0-9 ]')
+
+# Resources the browser does not need to load, the images are downloaded separately from their src attributes
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
 
 @task
 def thoughtful_automation_challenge():
@@ -79,79 +98,106 @@ def thoughtful_automation_challenge():
         logger.info("Page load, search and sorting finished!")
         ### END PAGE LOAD, SEARCH AND SORTING ###
 
-        ### BEGIN SEARCH RESULT EXTRACTION ###
-        logger.info("Starting search result extraction...")
-        # Keep track of the current page number and whether the limit has been reached
-        pagenum = 0
-        limit_reached = False
-        # Register results
-        rows = []
-        list_of_url_filename_pairs = []
-        while True:
-            pagenum += 1
-
-            # Parse the search results using BeautifulSoup
-            soup = parse_search_results(page)
-
-            # Loop through the search results and extract the relevant information
-            for li in soup.find_all('li'):
+        # Image downloads run in the background during the search result extraction
+        logger.info("Starting image download...")
+        with ThreadPoolExecutor(max_workers=IMG_DL_WORKERS) as executor:
+            ### BEGIN SEARCH RESULT EXTRACTION ###
+            logger.info("Starting search result extraction...")
+            # Keep track of the current page number and whether the limit has been reached
+            pagenum = 0
+            limit_reached = False
+            # Keep track of consecutive pages without new posts, in case the pagination stops advancing
+            stale_pages = 0
+            # Register results
+            rows = []
+            # Keep track of the posts already registered, results may repeat across pages
+            seen_keys = set()
+            # Images may be shared by several posts, only download each of them once
+            img_filenames = set()
+            while True:
+                pagenum += 1
+                rows_before = len(rows)
+
+                # Extract the raw search results from the page
                 page.wait_for_load_state()
-                row = extract_information_from_list_item(li)
-
-                post_date = row['date']
-                title = row['title']
-                description = row['description']
-                image_link = row['img_link']
-                img_filename = row['img_filename']
-
-                logger.debug(f"{post_date} - {title} - {description}")
-
-                # Check if the date is before the cutoff date, if so, stop the loop
-                if post_date < cutoff_date:
-                    limit_reached = True
+                items = extract_search_results(page)
+
+                # Loop through the search results and extract the relevant information
+                for item in items:
+                    row = extract_information_from_list_item(item)
+
+                    post_date = row['date']
+                    title = row['title']
+                    description = row['description']
+                    image_link = row['img_link']
+                    img_filename = row['img_filename']
+
+                    logger.debug(f"{post_date} - {title} - {description}")
+
+                    # Check if the date is before the cutoff date, if so, stop the loop
+                    if post_date < cutoff_date:
+                        limit_reached = True
+                        break
+
+                    # Skip posts that have already been registered
+                    if row['_key'] in seen_keys:
+                        continue
+                    seen_keys.add(row['_key'])
+
+                    # Start downloading the image while the remaining results are extracted
+                    if img_filename not in img_filenames:
+                        img_filenames.add(img_filename)
+                        executor.submit(download_image_to_disk,
+                                        image_link, img_filename)
+                    # Drop the image link and the deduplication key from the row
+                    row.pop('img_link')
+                    row.pop('_key')
+                    # Add the row to the list of rows
+                    rows.append(row)
+
+                # If the limit has been reached, break the loop
+                if limit_reached:
+                    break
+                # If several pages in a row brought no new posts, break the loop
+                stale_pages = stale_pages + 1 if len(rows) == rows_before else 0
+                if stale_pages >= 3:
+                    logger.info(
+                        f"No new results on the last {stale_pages} pages, stopping at page {pagenum}.")
+                    break
+                # Try to click the "Next stories" button, if it does not exist, break the loop
+                try:
+                    page.click("//button[contains(@aria-label, 'Next stories')]")
+                except:
                     break
+            logger.info("Search result extraction finished!")
+            ### END SEARCH RESULT EXTRACTION ###
 
-                # Add the image link and filename to the list of pairs
-                list_of_url_filename_pairs.append((image_link, img_filename))
-                # Drop the image link from the row
-                row.pop('img_link')
-                # Add the row to the list of rows
-                rows.append(row)
-
-            # If the limit has been reached, break the loop
-            if limit_reached:
-                break
-            # Try to click the "Next stories" button, if it does not exist, break the loop
-            try:
-                page.click("//button[contains(@aria-label, 'Next stories')]")
-            except:
-                break
-        logger.info("Search result extraction finished!")
-        ### END SEARCH RESULT EXTRACTION ###
-
-        ### BEGIN IMAGE DOWNLOAD ###
-        logger.info("Starting image download...")
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            for url, filename in list_of_url_filename_pairs:
-                executor.submit(download_image_to_disk, url, filename)
+            ### BEGIN IMAGE DOWNLOAD ###
+            logger.info("Waiting for the remaining image downloads...")
         logger.info("Images download finished!")
         ### END IMAGE DOWNLOAD ###
 
         ### BEGIN DATA PROCESSING ###
         logger.info("Starting data processing...")
         words = query.split()
-        # quick and easy, regular expression approach matching full words
+        # quick and easy, keyword automaton approach matching full words
         # more appropriate for this task would be a proper tokenization and stemming approach using spacy or nltk
+        # A single alphanumeric word, as in the default query, is counted with plain substring search
+        single_word = words[0].lower() if len(
+            words) == 1 and words[0].isalnum() else None
+        # Otherwise build the automaton of all query words once, so each row is scanned in a single linear pass
+        automaton = build_keyword_automaton(
+            words) if words and single_word is None else None
         for row in rows:
             # Calculate the count of the words of the query occuring in the title and image description
-            count = 0
             test_string = row['title'] + ' ' + row['description']
-            for word in words:
-                occurences = re.findall(
-                    rf"\b{word}\b", row['title'], re.IGNORECASE)
-                count += len(occurences)
-            row['count'] = count
-            # Check whether a price is mentioned in the title
+            if single_word is not None:
+                row['count'] = count_word_occurences(test_string, single_word)
+            elif automaton is not None:
+                row['count'] = count_keyword_occurences(test_string, automaton)
+            else:
+                row['count'] = 0
+            # Check whether a price is mentioned in the title or image description
             row['price'] = validate_price(test_string)
         logger.info("Data processing finished!")
         ### END DATA PROCESSING ###
@@ -159,8 +205,7 @@ def thoughtful_automation_challenge():
         ### BEGIN OUTPUT WRITING ###
         logger.info("Starting output writing...")
         # Create a new blank workbook with a worksheet "Results"
-        keep_chars = re.compile('[^a-zA-Z0-9 ]')
-        query_simple = "-".join([keep_chars.sub('', word) for word in words])
+        query_simple = "-".join([KEEP_CHARS.sub('', word) for word in words])
         write_rows_to_excel(
             rows, filepath=f"output/reuters_query-{query_simple}_cat-{category}_months-{months}.xlsx")
         output_payload['filename'] = (
@@ -182,8 +227,17 @@ def thoughtful_automation_challenge():
         workitems.outputs.create(payload=output_payload)
 
 
+def block_unneeded_resources(route: Route) -> None:
+    """ Abort the requests of resources that are never read from the page """
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+
 def open_page() -> browser.Page:
     """ Open the Reuters website and wait for it to load """
+    browser.context().route("**/*", block_unneeded_resources)
     page = browser.goto("https://www.reuters.com")
     page.wait_for_load_state()
     return page
@@ -220,9 +274,21 @@ def sortby(page: browser.Page, sortby: Literal['Newest', 'Oldest', 'Relevance']
 def download_image_to_disk(url: str, filename: str) -> None:
     """ Download an image from the given URL to the given filename """
     logger.debug(f"Downloading {url} to {filename}")
-    urlretrieve(url, filename)
+    response = http_pool.request("GET", url, preload_content=False)
+    try:
+        if response.status != 200:
+            logger.warning(f"Could not download {url}: HTTP {response.status}")
+            # Discard the unread body so that the connection can be reused
+            response.drain_conn()
+            return
+        # Stream the body to disk, the connection is returned to the pool afterwards
+        with open(filename, 'wb') as f:
+            shutil.copyfileobj(response, f)
+    finally:
+        response.release_conn()
 
 
+@lru_cache(maxsize=8192)
 def validate_price(test_string: str) -> bool:
     """
     Validates whether a price is mentioned in the given string.
@@ -233,69 +299,136 @@ def validate_price(test_string: str) -> bool:
     Returns:
         bool: True if a price is found, False otherwise.
     """
-    # The pattern to isolate the potential price candidates. Match sequences of digits, commas and periods, making sure the string does not end with a comma or period.
-    pattern_isolate = r'\$[\d,\.]+(?<![,\.])|\b[\d,\.]+(?<![,\.]) (dollars|USD)\b$'
-    # The pattern to validate the isolated candidates. Make sure the string either starts with a dollar sign or ends with "dollars" or "USD". Enforce that the number starts with a non-zero digit and that commas are used as separators for thousands.
-    pattern_validate = r'^\$[1-9]\d{0,2}(,\d{3})*(\.\d+)?$|\b[1-9]\d{0,2}(,\d{3})*(\.\d+)? (dollars|USD)\b$'
-    candidates = re.finditer(pattern_isolate, test_string)
-    for candidate in candidates:
-        if re.match(pattern_validate, candidate.group()):
-            return True
-    return False
-
-
-def parse_search_results(page: browser.Page) -> BeautifulSoup:
-    """ Parse the search results using BeautifulSoup """
-    locator = page.locator("//ul[contains(@class, 'search-results')]")
-    locator.wait_for()
-    html = locator.evaluate("(e) => e.outerHTML")
-    soup = BeautifulSoup(html, "html.parser")
-    return soup
+    # Cheap prefilter, a price can only be found if a dollar sign, "dollars" or "USD" is present
+    if '$' not in test_string and 'dollars' not in test_string and 'USD' not in test_string:
+        return False
+    return bool(DOLLAR_RE.search(test_string) or SUFFIX_RE.search(test_string))
 
 
-def extract_information_from_list_item(li: BeautifulSoup) -> dict:
-    """ Extract information from a list item in the search results """
-    title = li.find('span', attrs={'data-testid': 'Heading'}).text
-    datetime_string = li.find('time').get('datetime')
-    # Observation: Label my not exist in all cases
-    try:
-        label = li.find('span', attrs={'data-testid': 'Label'}).text
-    except:
-        label = ''
+def build_keyword_automaton(words: list[str]) -> ahocorasick.Automaton:
+    """
+    Builds an Aho-Corasick automaton matching the given words case-insensitively.
 
-    # Parse the datetime string into a date object
-    try:
-        post_datetime = datetime.strptime(
-            datetime_string, '%Y-%m-%dT%H:%M:%S.%fZ')
-    except ValueError:
-        post_datetime = datetime.strptime(
-            datetime_string, '%Y-%m-%dT%H:%M:%SZ')
-    post_date = post_datetime.date()
+    Args:
+        words, list[str]: The words to be matched.
+
+    Returns:
+        ahocorasick.Automaton: The automaton, storing the length of each word as its value.
+    """
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        keyword = word.lower()
+        automaton.add_word(keyword, len(keyword))
+    automaton.make_automaton()
+    return automaton
 
-    hash_object = shake_128()
-    hash_object.update(datetime_string.encode('utf-8'))
-    hash_object.update(title.encode('utf-8'))
 
-    hex_dig = hash_object.hexdigest(8)
+def _is_word_char(char: str) -> bool:
+    """ Check whether a character is a word character in the sense of regular expressions """
+    return char.isalnum() or char == '_'
 
-    image_link = li.find('img').get('src')
-    file_type = image_link.split('.')[-1]
-    description = li.find('img').get('alt', '')
-    img_filename = f"output/{hex_dig}.{file_type}"
+
+def _is_word_boundary(text: str, index: int) -> bool:
+    """ Check whether the given position in the text is a word boundary in the sense of regular expressions """
+    before = index > 0 and _is_word_char(text[index - 1])
+    after = index < len(text) and _is_word_char(text[index])
+    return before != after
+
+
+@lru_cache(maxsize=8192)
+def count_word_occurences(test_string: str, word: str) -> int:
+    """
+    Counts the full word occurences of a single lowercase word in the given string.
+
+    Args:
+        test_string, str: The string to be searched for the word.
+        word, str: The lowercase word to be counted.
+
+    Returns:
+        int: The number of word occurences delimited by word boundaries.
+    """
+    test_string_lower = test_string.lower()
+    count = 0
+    index = test_string_lower.find(word)
+    while index != -1:
+        end_index = index + len(word)
+        if _is_word_boundary(test_string_lower, index) and _is_word_boundary(test_string_lower, end_index):
+            count += 1
+            index = test_string_lower.find(word, end_index)
+        else:
+            index = test_string_lower.find(word, index + 1)
+    return count
+
+
+@lru_cache(maxsize=8192)
+def count_keyword_occurences(test_string: str, automaton: ahocorasick.Automaton) -> int:
+    """
+    Counts the full word occurences of the automaton keywords in the given string.
+
+    Args:
+        test_string, str: The string to be searched for the keywords.
+        automaton, ahocorasick.Automaton: The automaton built by build_keyword_automaton.
+
+    Returns:
+        int: The number of keyword occurences delimited by word boundaries.
+    """
+    test_string_lower = test_string.lower()
+    count = 0
+    for end_index, length in automaton.iter(test_string_lower):
+        start_index = end_index - length + 1
+        # Only count full words, checking the neighbouring characters instead of running a regex
+        if _is_word_boundary(test_string_lower, start_index) and _is_word_boundary(test_string_lower, end_index + 1):
+            count += 1
+    return count
+
+
+def extract_search_results(page: browser.Page) -> list[dict]:
+    """ Extract the raw fields of every search result directly from the DOM """
+    locator = page.locator("//ul[contains(@class, 'search-results')]")
+    locator.wait_for()
+    # Read only the needed attributes in the browser instead of serializing and re-parsing the HTML
+    items = locator.evaluate("""(ul) => Array.from(ul.querySelectorAll('li')).map(li => ({
+        title: li.querySelector('span[data-testid=Heading]')?.textContent,
+        datetime: li.querySelector('time')?.getAttribute('datetime'),
+        src: li.querySelector('img')?.getAttribute('src'),
+        alt: li.querySelector('img')?.getAttribute('alt') ?? ''
+    }))""")
+    return items
+
+
+def extract_information_from_list_item(item: dict) -> dict:
+    """ Extract information from the raw fields of a search result """
+    title = item['title']
+    datetime_string = item['datetime']
+
+    # Parse the date part of the ISO 8601 datetime string (YYYY-MM-DDTHH:MM:SS[.fff]Z) into a date object
+    post_date = date(int(datetime_string[0:4]), int(
+        datetime_string[5:7]), int(datetime_string[8:10]))
+
+    image_link = item['src']
+    description = item['alt']
+    # The image URL already ends with a unique basename, drop the query string
+    img_filename = f"output/{urlparse(image_link).path.rsplit('/', 1)[-1]}"
 
     row = {
         'date': post_date,
         'title': title,
         'description': description,
         "img_link": image_link,
-        "img_filename": img_filename
+        "img_filename": img_filename,
+        "_key": (datetime_string, title)
     }
     return row
 
 
-def write_rows_to_excel(rows: dict, filepath: str = "output/reuters_results.xlsx") -> None:
+def write_rows_to_excel(rows: list[dict], filepath: str = "output/reuters_results.xlsx") -> None:
     """ Write the extracted rows to an Excel file """
-    excel = Excel()
-    excel.create_workbook(filepath)
-    excel.create_worksheet(name="Results", content=rows, header=True)
-    excel.save_workbook()
+    # Write-only workbooks stream the rows to disk instead of keeping every cell in memory
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Results")
+    if rows:
+        header = list(rows[0].keys())
+        worksheet.append(header)
+        for row in rows:
+            worksheet.append([row[key] for key in header])
+    workbook.save(filepath)